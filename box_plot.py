@@ -1,38 +1,70 @@
 """ Create a box plot of the data in a csv file. """
 
+import argparse
+
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
+
+
+# Columns read from the csv - grouping keys are categorical so groupby works on integer codes rather than hashing strings
+DTYPES = {
+    'Run Name': 'category',
+    'Data Normalization': 'category',
+    'SSIM': 'float32',
+    'PSNR': 'float32',
+    'SAM': 'float32',
+    'ERGAS': 'float32',
+}
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save', action='store_true', help='Save the plot to save_file with the non-interactive Agg backend instead of displaying it.')
+    parser.add_argument('--save_file', type=str, default='boxplot.png', help='Output file to save the plot to (if save is specified).')
+    opt = parser.parse_args()
+
+    return opt
+
 
 if __name__ == "__main__":
-    df = pd.read_csv('Results/Data_Norm_by_model.csv')
+    opt = parse_opt()
+
+    # Select the backend before pyplot is imported so no GUI toolkit is initialised when saving
+    if opt.save:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    df = pd.read_csv('Results/Data_Norm_by_model.csv', dtype=DTYPES, usecols=list(DTYPES), engine='c')
 
     # Remove any rows that contain all NaN values
     df = df.dropna(how='all')
 
     # Populate NaN values in df with value in the same column that share the same value in the 'Run Name' column
-    df = df.fillna(df.groupby('Run Name').transform('first'))
+    #  Only columns that actually contain NaN values are looked up (skipped entirely if there are none)
+    na_cols = df.columns[df.isna().any()].drop('Run Name', errors='ignore')
+    if len(na_cols):
+        first_vals = df.groupby('Run Name', sort=False, observed=True)[na_cols].first()
+        df[na_cols] = df[na_cols].fillna(first_vals.reindex(df['Run Name']).set_axis(df.index))
 
     print(df)
 
     # Create 4 box plots, one for metric (SSIM, PSNR, SAM, ERGAS) grouped by 'Data Normalization' (do not share y-axis)
-    fig, axes = plt.subplots(2, 2, figsize=(8, 8), sharey=False)
-    df.boxplot(column=['SSIM'], by='Data Normalization', ax=axes[0,0], rot=45)
-    df.boxplot(column=['PSNR'], by='Data Normalization', ax=axes[0,1], rot=45)
-    df.boxplot(column=['SAM'], by='Data Normalization', ax=axes[1,0], rot=45)
-    df.boxplot(column=['ERGAS'], by='Data Normalization', ax=axes[1,1], rot=45)
-
-    # Remove x-axis labels from top row
-    axes[0, 0].set_xticklabels([])
-    axes[0, 1].set_xticklabels([])
-
-    # Remove 'Data Normalization' label from x-axis
-    axes[0, 0].set_xlabel('')
-    axes[0, 1].set_xlabel('')
-    axes[1, 0].set_xlabel('')
-    axes[1, 1].set_xlabel('')
+    # A single call groups the data once and lays out all 4 axes
+    axes = df.boxplot(column=['SSIM', 'PSNR', 'SAM', 'ERGAS'], by='Data Normalization', layout=(2, 2), figsize=(8, 8), sharex=False, sharey=False, rot=45)
+    fig = axes[0, 0].get_figure()
 
-    fig.suptitle('Model Performance by Data Normalization Method')
+    for ax in axes[0]:
+        # Remove x-axis labels from top row
+        ax.set_xticklabels([])
+
+    for ax in axes.flat:
+        # Remove 'Data Normalization' label from x-axis
+        ax.set_xlabel('')
 
-    # Display the plot
-    plt.show()
+    fig.suptitle('Model Performance by Data Normalization Method')
 
+    if opt.save:
+        fig.savefig(opt.save_file, dpi=100, bbox_inches='tight')
+    else:
+        # Display the plot
+        plt.show()
@@ -5,12 +5,143 @@ import datetime
 import pytz
 import json
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd 
 import wandb
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def filter_runs(runs, group_filter=None, jt_filter=None, config_filter=None, results_filter=None, include_timestamp=False, show_keys=False):
+
+# (column name substring, decimal places) - checked in order against lower case column names
+ROUNDING_RULES = [
+    ('accuracy', 2),
+    ('f1_score', 3),
+    ('lr', 6),
+    ('ssim', 4),
+    ('psnr', 3),
+    ('sam', 3),
+    ('ergas', 3),
+    ('timestamp', 0),
+]
+
+# Parquet file metadata key holding the wandb project of a runs cache
+CACHE_PROJECT_KEY = b'wandb_project'
+
+# Variable name separators replaced with spaces in column titles
+TITLE_TRANSLATION = str.maketrans({'/': ' ', '_': ' '})
+
+
+def json_loads(raw):
+    """ Decode a JSON string with orjson if installed, otherwise the standard library json """
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN/Infinity values the standard library json writes (e.g. a NaN metric or inf best loss)
+            pass
+    return json.loads(raw)
+
+
+def map_in_order(executor, fn, iterable, max_pending):
+    """ Like executor.map, but consumes iterable lazily and keeps at most max_pending items in flight
+
+    Results are yielded in input order. Unlike executor.map, items are not all submitted up front, so references to
+    already processed runs are not held for the whole call.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class CachedSummary:
+    """ Stand-in for a wandb api run summary, holding the raw summary JSON loaded from the runs cache - decoded on first access """
+
+    def __init__(self, raw_json):
+        self._json = raw_json
+        self._decoded = None
+
+    @property
+    def _json_dict(self):
+        if self._decoded is None:
+            self._decoded = json_loads(self._json)
+        return self._decoded
+
+
+class CachedRun:
+    """ Stand-in for a wandb api Run with the attributes used by filter_runs, loaded from the runs cache """
+
+    def __init__(self, group, job_type, name, config, summary_json):
+        self.group = group
+        self.job_type = job_type
+        self.name = name
+        self.config = config
+        self.summary = CachedSummary(summary_json)
+
+
+def save_runs_cache(runs, cache_file, project, workers=16):
+    """ Snapshot the raw (unfiltered) data of wandb api runs to a parquet file
+
+    :runs:       wandb api runs to snapshot
+    :cache_file: parquet file to save the runs to
+    :project:    wandb project the runs belong to - stored in the file metadata
+    :workers:    number of threads used to fetch run data from the wandb api
+
+    returns the snapshotted runs as a list of CachedRun
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def run_to_row(run):
+        # config and summary have arbitrary nested keys, so store them as JSON strings
+        return {'group': run.group,
+                'job_type': run.job_type,
+                'name': run.name,
+                'config': json.dumps(dict(run.config), default=str),
+                'summary': json.dumps(run.summary._json_dict, default=str)}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = list(map_in_order(executor, run_to_row, runs, max_pending=2 * workers))
+
+    cache_df = pd.DataFrame(rows, columns=['group', 'job_type', 'name', 'config', 'summary'])
+    table = pa.Table.from_pandas(cache_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), CACHE_PROJECT_KEY: project.encode()})
+    pq.write_table(table, cache_file)
+    return runs_from_cache_df(cache_df)
+
+
+def load_runs_cache(cache_file, project):
+    """ Load runs snapshotted by save_runs_cache
+
+    :cache_file: parquet file the runs were saved to
+    :project:    wandb project the runs must belong to
+
+    returns the cached runs as a list of CachedRun, or None if the cache is for a different project
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(cache_file).metadata or {}
+    if metadata.get(CACHE_PROJECT_KEY) != project.encode():
+        return None
+    return runs_from_cache_df(pd.read_parquet(cache_file))
+
+
+def runs_from_cache_df(cache_df):
+    """ Convert runs cache DataFrame rows into CachedRun objects """
+    return [CachedRun(row.group, row.job_type, row.name, json_loads(row.config), row.summary)
+            for row in cache_df.itertuples(index=False)]
+
+
+def filter_runs(runs, group_filter=None, jt_filter=None, config_filter=None, results_filter=None, include_timestamp=False, show_keys=False, workers=16):
     """ filter wandb api runs by values - any None filters are ignored
 
     :group_filter:      Wandb run group name to retrieve
@@ -19,65 +150,132 @@ def filter_runs(runs, group_filter=None, jt_filter=None, config_filter=None, res
     :results_filter:    list of results metrics to filter by
     :include_timestamp: include timestamp of runs
     :show_keys:         print the config and summary keys to console on the first valid run
+    :workers:           number of threads used to fetch run data from the wandb api
 
     returns filtered results as a pandas DataFrame
     """
 
-    output = []
-
-    for run in runs:
-        if (run.group == group_filter or group_filter == "") and (run.job_type == jt_filter or jt_filter == ""):
-
-            run_params = {}
-            run_params['group'] = run.group
-            run_params['job_type'] = run.job_type
-            run_params['run_name'] = run.name
-
-            # .config contains the hyperparameters.
+    if results_filter:
+        # Duplicate metric names would otherwise write the same metric twice
+        results_filter = list(dict.fromkeys(results_filter))
+
+    # 'specific' keeps the listed config keys, 'different' keeps config values that differ between runs, 'all' keeps every config value
+    cf_mode = 'specific' if (config_filter and config_filter[0].lower() != 'different') else ('different' if config_filter else 'all')
+
+    # Check the empty filters first so run.group/run.job_type are not accessed when no filter is applied
+    skip_group = not group_filter
+    skip_jt = not jt_filter
+
+    def extract_run(run):
+        """ Extract the params of a single run - returns (run params, results_filter found flags, results_filter values, keys to show), or None if the run is filtered out """
+        if not ((skip_group or run.group == group_filter) and (skip_jt or run.job_type == jt_filter)):
+            return None
+
+        run_params = {}
+        run_params['group'] = run.group
+        run_params['job_type'] = run.job_type
+        run_params['run_name'] = run.name
+
+        # .config contains the hyperparameters.
+        if cf_mode == 'specific':
+            # Only index the requested keys - no need to copy the whole config
+            config = run.config
+            run_params.update({k: config[k] for k in config_filter})
+        else:
             #  We remove special values that start with _.
             config = {k: v for k, v in run.config.items()
                 if not k.startswith('_')}
-
-            if config_filter and config_filter[0].lower() != "different":
-                for config_param in config_filter:
-                    run_params[config_param] = config[config_param]
-            else:
-                run_params.update(config)   # All
-
-            # .summary contains the output keys/values for metrics like accuracy.
-            #  We call ._json_dict to omit large files 
-            summary = run.summary._json_dict
-
-            if show_keys:
-                print("Config keys: ", config.keys())
-                print("Summary keys: ", summary.keys())
-                show_keys = False
-
-            if results_filter:
-                valid_result = False
-                for summary_param in results_filter:
-                    if summary_param in summary.keys():
-                        value = summary[summary_param]
-                        # if 'accuracy' in summary_param:
-                        #     value = round(value, 2)
-                        # elif 'f1_score' in summary_param:
-                        #     value = round(value, 3)
-                        run_params[summary_param] = value
-                        valid_result = True
-                if valid_result:
-                    if include_timestamp:
-                        run_params['timestamp'] = summary['_timestamp']
-                    output.append(run_params)   # Only add if results_filter is specified and found (if not found, likely a different run type or not finished)
-            else:
-                run_params.update(summary)  # All
-                output.append(run_params)
-
-    if len(output) == 0:
+            run_params.update(config)   # All
+
+        # .summary contains the output keys/values for metrics like accuracy.
+        #  We call ._json_dict to omit large files 
+        summary = run.summary._json_dict
+
+        # Keys are printed by the caller for the first valid run, in run order
+        run_keys = None
+        if show_keys:
+            # config is the raw run.config in specific mode, so hide the special _ keys here too
+            run_keys = ([k for k in config if not k.startswith('_')], summary.keys())
+
+        if results_filter:
+            found = [summary_param in summary for summary_param in results_filter]
+            if not any(found):
+                return None     # Only add if results_filter is specified and found (if not found, likely a different run type or not finished)
+            result_values = [summary.get(summary_param, math.nan) for summary_param in results_filter]
+            if include_timestamp:
+                found.append(True)
+                result_values.append(summary.get('_timestamp', math.nan))
+            return run_params, found, result_values, run_keys
+
+        run_params.update(summary)  # All
+        return run_params, None, None, run_keys
+
+    # Accumulate results column-wise by kept row so the DataFrame is built directly from lists, padding missing keys with NaN
+    columns = {}
+    n_rows = 0
+
+    # Column order of first appearance, as a DataFrame built from row dicts would have
+    column_order = {}
+
+    # results_filter metrics (and timestamp) have a fixed set of keys, so write them straight into preallocated column arrays.
+    #  wandb api runs support len() without being fetched, which bounds the number of kept rows
+    result_keys = []
+    if results_filter:
+        result_keys = results_filter + (['timestamp'] if include_timestamp else [])
+    capacity = len(runs) if hasattr(runs, '__len__') else 64
+    result_arrays = [np.full(capacity, np.nan, dtype=object) for _ in result_keys]
+    # Per row flags of which result keys were found, so config values of the same name are only overwritten where found
+    found_arrays = [np.zeros(capacity, dtype=bool) for _ in result_keys]
+
+    # Run data is lazily fetched from the wandb api, so overlap the requests across threads
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for extracted in map_in_order(executor, extract_run, runs, max_pending=2 * workers):
+            if extracted is None:
+                continue
+            run_params, found, result_values, run_keys = extracted
+            if n_rows == 0 and run_keys is not None:
+                print("Config keys: ", run_keys[0])
+                print("Summary keys: ", run_keys[1])
+            for k, v in run_params.items():
+                col = columns.get(k)
+                if col is None:
+                    col = columns[k] = [math.nan] * n_rows
+                    column_order[k] = None
+                elif len(col) < n_rows:
+                    col.extend([math.nan] * (n_rows - len(col)))
+                col.append(v)
+
+            if result_values is not None:
+                if n_rows == capacity:
+                    # More runs than expected - grow the result arrays
+                    extra = max(capacity, 64)
+                    result_arrays = [np.concatenate([arr, np.full(extra, np.nan, dtype=object)]) for arr in result_arrays]
+                    found_arrays = [np.concatenate([arr, np.zeros(extra, dtype=bool)]) for arr in found_arrays]
+                    capacity += extra
+                for arr, found_arr, v, is_found in zip(result_arrays, found_arrays, result_values, found):
+                    arr[n_rows] = v
+                    found_arr[n_rows] = is_found
+                # Metrics not found in any run are left out of the output
+                for k, is_found in zip(result_keys, found):
+                    if is_found:
+                        column_order.setdefault(k, None)
+            n_rows += 1
+
+    if n_rows == 0:
         raise Exception("No runs found for given filters. Please check valid values are passed.")
 
-    df = pd.DataFrame(output)
+    for col in columns.values():
+        col.extend([math.nan] * (n_rows - len(col)))
+
+    for k, arr, found_arr in zip(result_keys, result_arrays, found_arrays):
+        arr, found_arr = arr[:n_rows], found_arr[:n_rows]
+        if k in columns:
+            # A config value of the same name is only replaced in rows where the metric was found
+            arr = np.where(found_arr, arr, np.array(columns[k], dtype=object))
+        columns[k] = arr
+    df = pd.DataFrame({k: columns[k] for k in column_order}).infer_objects()
 
-    if config_filter and config_filter[0].lower() == 'different':
+    if cf_mode == 'different':
         df = remove_constant_columns(df)
     return df
 
@@ -89,46 +287,87 @@ def remove_constant_columns(df):
 
     returns pandas.DataFrame: A new DataFrame without the constant columns.
     """
-    # Initialize an empty list to store constant columns
-    constant_columns = []
+    # Count unique values per column (NaN counts as a value)
+    try:
+        n_unique = df.nunique(dropna=False)
+    except TypeError:
+        # Unhashable values (e.g. list configs) - only those columns fall back to comparing string representations
+        n_unique = {}
+        for col in df.columns:
+            try:
+                n_unique[col] = df[col].nunique(dropna=False)
+            except TypeError:
+                n_unique[col] = len(set(df[col].apply(str)))
+        n_unique = pd.Series(n_unique)
+
+    # If there's only one unique value, it means all values in the column are the same
+    constant_columns = n_unique.index[n_unique <= 1]
 
-    for col in df.columns:
-        # Convert column values to their string representations
-        str_values = df[col].apply(str)
+    # Drop constant columns
+    return df.drop(columns=constant_columns)
 
-        # Get the set of unique string representations
-        unique_str_values = set(str_values)
 
-        # If there's only one unique value, it means all values in the column are the same
-        if len(unique_str_values) == 1:
-            constant_columns.append(col)
+def get_column_title(col):
+    """ Alter a column name from a variable name to a better title """
+    renamed_col = col.translate(TITLE_TRANSLATION).title()   # Replace separators with spaces and capitalize each word
 
-    # Drop constant columns
-    return df.drop(columns=constant_columns)
+    # .title() method messes up LR and NN capitalization
+    return renamed_col.replace('Lr', 'LR').replace('Nn', 'NN')
 
 
 def get_columns_mapper(df):
     """ Alter column names from variable names to better titles """
+    return {col: get_column_title(col) for col in df.columns}
+
 
-    columns_mapper = {}
-    for col in df.columns:
-        renamed_col = col.replace('/', ' ')
-        renamed_col = renamed_col.replace('_', ' ')
-        renamed_col = renamed_col.title()   # Capitalize each word
+def save_results(df, save_file, fast_io=False):
+    """ Save results DataFrame to file
 
-        # .title() method messes up LR and NN capitalization
-        renamed_col = renamed_col.replace('Lr', 'LR')
-        renamed_col = renamed_col.replace('Nn', 'NN')
-        columns_mapper[col] = renamed_col
-    return columns_mapper
+    :df:        (pandas.DataFrame): Results to save.
+    :save_file: Output file path. A .parquet extension saves as parquet, otherwise csv.
+    :fast_io:   Write csv files with the pyarrow writer if pyarrow is installed.
+    """
+    if save_file.endswith('.parquet'):
+        df.to_parquet(save_file)
+        return
+
+    if fast_io:
+        try:
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+        except ImportError:
+            print("pyarrow not installed, falling back to pandas csv writer.")
+        else:
+            # Keep the index as an unnamed first column like the pandas writer.
+            #  Note pyarrow quotes all strings (including the header) and writes booleans as true/false
+            try:
+                table = pa.Table.from_pandas(df.rename_axis('').reset_index(), preserve_index=False)
+                pa_csv.write_csv(table, save_file)
+                return
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                # e.g. list/dict config values or mixed type columns
+                print(f"pyarrow can't write these results ({e}), falling back to pandas csv writer.")
+
+    df.to_csv(save_file)
 
 
 def main():
     opt = parse_opt()
-    api = wandb.Api()
 
-    # Project is specified by <entity/project-name>
-    runs = api.runs(opt.project)
+    runs = None
+    if opt.use_cache and not opt.refresh_cache and os.path.exists(opt.cache_file):
+        runs = load_runs_cache(opt.cache_file, opt.project)
+        if runs is None:
+            print(f"{opt.cache_file} is not a cache of {opt.project}, fetching runs from wandb.")
+
+    if runs is None:
+        api = wandb.Api()
+
+        # Project is specified by <entity/project-name>
+        runs = api.runs(opt.project)
+
+        if opt.use_cache or opt.refresh_cache:
+            runs = save_runs_cache(runs, opt.cache_file, opt.project, workers=opt.workers)
 
     df = filter_runs(runs,
                      group_filter=opt.group_filter,
@@ -136,38 +375,31 @@ def main():
                      config_filter=opt.config_filter,
                      results_filter=opt.results_filter,
                      include_timestamp=opt.include_timestamp,
-                     show_keys=opt.show_keys)
-
-    if opt.sort_by:
-        df = df.sort_values(by=opt.sort_by, ascending=False)
+                     show_keys=opt.show_keys,
+                     workers=opt.workers)
 
+    # nlargest returns rows already sorted by best_metric, so a prior sort_by sort would be discarded
     if opt.best_metric:
         df = df.nlargest(opt.n_largest, opt.best_metric)
+    elif opt.sort_by:
+        df = df.sort_values(by=opt.sort_by, ascending=False)
 
-    # Round values
-    for col in df.columns:
-        if 'accuracy' in col and isinstance(df[col][0], float):
-            df[col] = df[col].round(2)
-        elif 'f1_score' in col and isinstance(df[col][0], float):
-            df[col] = df[col].round(3)
-        elif 'lr' in col and isinstance(df[col][0], float):
-            df[col] = df[col].round(6)
-        elif 'ssim' in col.lower() and isinstance(df[col][0], float):
-            df[col] = df[col].round(4)
-        elif 'psnr' in col.lower() and isinstance(df[col][0], float):
-            df[col] = df[col].round(3)
-        elif 'sam' in col.lower() and isinstance(df[col][0], float):
-            df[col] = df[col].round(3)
-        elif 'ergas' in col.lower() and isinstance(df[col][0], float):
-            df[col] = df[col].round(3)
-        elif 'timestamp' in col.lower() and isinstance(df[col][0], float):
-            df[col] = df[col].round(0)
+    # Round values - first matching rule for each float column wins
+    decimals = {}
+    for col, dtype in df.dtypes.items():
+        if dtype.kind == 'f':
+            lower_col = col.lower()
+            for sub, d in ROUNDING_RULES:
+                if sub in lower_col:
+                    decimals[col] = d
+                    break
+    df = df.round(decimals)
 
     # Convert variable names into nicer looking titles
     columns_mapper = get_columns_mapper(df)
     df = df.rename(columns=columns_mapper)
 
-    df.to_csv(opt.save_file)
+    save_results(df, opt.save_file, fast_io=opt.fast_io)
 
 
 def parse_opt():
@@ -179,11 +411,16 @@ def parse_opt():
     parser.add_argument('--config_filter', nargs="+", type=str, default=[], help="Config (training parameters) to add to output. Default all. Can pass 'different' which will identify and keep columns containing different values (i.e. not the same parameter for each)")
     parser.add_argument('--results_filter', nargs="+", type=str, default=[], help="Result(s) metrics to add to output. Default all.")
     parser.add_argument('--save_file', type=str, default='results.csv', help='Output file to save results to.')
+    parser.add_argument('--fast_io', action='store_true', help='Write csv output with pyarrow (if installed and results are arrow compatible) - strings are quoted and booleans written as true/false. Pass a .parquet save_file to save as parquet.')
     parser.add_argument('--best_metric', type=str, default="", help="Evaluation metric to return n_largest results based on. Default not applied.")
     parser.add_argument('--n_largest', type=int, default=5, help='Number of best_metric runs to return (if best_metric is specified).')
     parser.add_argument('--show_keys', action='store_true', help='Print the config and summary keys to console on the first valid run.')
-    parser.add_argument('--sort_by', nargs="+", type=str, default=[], help="Sort results by column name. Multiple columns can be specified. Default not applied.")
+    parser.add_argument('--sort_by', nargs="+", type=str, default=[], help="Sort results by column name. Multiple columns can be specified. Ignored if best_metric is specified. Default not applied.")
     parser.add_argument('--include_timestamp', action='store_true', help='Include timestamp of runs.')
+    parser.add_argument('--use_cache', action='store_true', help='Load runs from cache_file if it exists, otherwise fetch runs from wandb and save them to cache_file.')
+    parser.add_argument('--refresh_cache', action='store_true', help='Fetch runs from wandb and overwrite cache_file.')
+    parser.add_argument('--cache_file', type=str, default='runs_cache.parquet', help='Parquet file to cache raw (unfiltered) runs in. A cache of a different project is refetched and overwritten.')
+    parser.add_argument('--workers', type=int, default=16, help='Number of threads used to fetch run data from wandb.')
     opt = parser.parse_args()
 
     return opt